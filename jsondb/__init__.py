@@ -21,14 +21,134 @@
 #  SOFTWARE.
 #
 
-from typing import Optional, Hashable, Any, TextIO, Sequence, Callable
+from typing import Optional, Hashable, Any, BinaryIO, Sequence, Callable, Iterable, Iterator
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import itemgetter
 from pathlib import Path
 import json
+import mmap
 import io
+import os
+import re
+import tempfile
 
 from jsondb.errors import *
 
 
+def _std_dumps(obj: Any) -> bytes:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+# Prefer the fastest available JSON backend. All of them are wrapped to produce compact UTF-8 bytes.
+try:
+    import orjson as _json
+
+    # Integers this long may not fit in 64 bits.
+    _LONG_INT = re.compile(rb"\d{20}")
+
+    def _dumps(obj: Any) -> bytes:
+        # orjson writes NaN and Infinity as null and rejects integers beyond 64 bits. Anything that may hold those is
+        # left to the stdlib, so the stored data doesn't depend on the backend.
+        try:
+            data: bytes = _json.dumps(obj, option=_json.OPT_NON_STR_KEYS)
+        except _json.JSONEncodeError:
+            return _std_dumps(obj)
+        return _std_dumps(obj) if b"null" in data else data
+
+    def _loads(data: bytes) -> Any:
+        # orjson reads integers beyond 64 bits as floats and rejects NaN and Infinity. Leave those to the stdlib too.
+        if _LONG_INT.search(data) is None:
+            try:
+                return _json.loads(data)
+            except _json.JSONDecodeError:
+                pass
+        return json.loads(data)
+except ImportError:
+    try:
+        import ujson as _json
+
+        def _dumps(obj: Any) -> bytes:
+            return _json.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode()
+    except ImportError:
+        _json = json
+        _dumps = _std_dumps
+
+    _loads: Callable[[bytes | str], Any] = _json.loads
+
+# Optional SIMD accelerated parser. Once documents are converted to Python objects it is only faster than the ujson
+# and json fallbacks, not orjson, so it is only used without orjson.
+simdjson = None
+if _json.__name__ != "orjson":
+    try:
+        import simdjson
+    except ImportError:
+        pass
+
+# Buffer size used for the database file.
+_BUFFER_SIZE: int = 1 << 20
+
+# Initial number of bytes read per record when the database can't be memory mapped.
+_PREAD_SIZE: int = 4096
+
+# Number of bytes read at a time, backwards from the end of the database, when looking for the index pointer written by
+# older versions.
+_TAIL_SIZE: int = 4096
+
+# Number of fragments allowed to build up in the index file before add() compacts them into one.
+_COMPACT_THRESHOLD: int = 64
+
+
+@lru_cache(maxsize=4096, typed=True)
+def _record_prefix(key: Hashable) -> bytes:
+    """
+    Encodes the start of a record for a key, up to where its value begins.
+    Parameters
+    ----------
+    key: Hashable
+        Key of the record.
+    Returns
+    -------
+    bytes
+        The encoded '{key:' prefix.
+    """
+    # Encode through a dict so non-str keys are converted the same way the encoder converts index keys.
+    return _dumps({key: 0})[:-len(b"0}")]
+
+
+def _encode_records(items: dict, buf: bytearray, base: int) -> dict:
+    """
+    Encodes entries as records into one block, tracking positions arithmetically.
+    Parameters
+    ----------
+    items: dict
+        Entries to encode.
+    buf: bytearray
+        Block to append the records to.
+    base: int
+        Position in the database that buf will be written at.
+    Returns
+    -------
+    dict
+        Index fragment holding the position of each record.
+    """
+    delta: dict = {}
+
+    # Bind names used in the loop to locals.
+    dumps: Callable[[Any], bytes] = _dumps
+    record_prefix: Callable[[Hashable], bytes] = _record_prefix
+    extend: Callable[[bytes], None] = buf.extend
+    for key, value in items.items():
+        # Add new position to index fragment. Keys are unique within items.
+        delta[key] = [base + len(buf)]
+
+        extend(record_prefix(key))
+        extend(dumps(value))
+        extend(b"}\n")
+
+    return delta
+
+
 class Jsondb:
     def __init__(self, path: Path | str) -> None:
         """
@@ -39,39 +159,156 @@ class Jsondb:
             Path to the database file.
         """
         self.__path: Path = Path(path)
+        self.__index_path: Path = self.__path.with_name(self.__path.name + ".idx")
         self.__index: dict = {}
+        self.__index_dirty: bool = True
+        self.__fragment_count: int = 0
+        # Size of the index file as last read or written by this instance, not counting pending fragments.
+        self.__index_size: int = 0
+        # Fragments not yet written to the index file. Kept here rather than in a file buffer so they are only ever
+        # written after the records they point at.
+        self.__index_pending: bytearray = bytearray()
+        # Whether the index file ends in a partial fragment, so the next one must start with a newline.
+        self.__index_torn: bool = False
+        # Index entries held back until the outermost batch exits.
+        self.__batch_depth: int = 0
+        self.__batch_delta: dict = {}
 
         self.path.touch(exist_ok=True)
 
-        self.__fio: TextIO | None = None
+        self.__parser = simdjson.Parser() if simdjson is not None else None
+
+        self.__fio: BinaryIO | None = None
+        # End of the database, including buffered writes. Tracked so add() never needs to seek, which would flush.
+        self.__data_size: int = 0
+        self.__ifio: BinaryIO | None = None
+        self.__mm: mmap.mmap | None = None
+        # Bumped by add(). The map is refreshed before reading whenever it is behind.
+        self.__generation: int = 0
+        self.__mm_generation: int = -1
         self.open()
 
     @property
     def path(self) -> Path:
         return self.__path
 
+    @property
+    def index_path(self) -> Path:
+        return self.__index_path
+
     def open(self) -> None:
         """
-        Open database file for IO access.
+        Open database and index files for IO access.
         """
         if self.__fio is None:
-            self.__fio: TextIO = open(self.path, "r+")
+            self.__fio: BinaryIO = open(self.path, "r+b", buffering=_BUFFER_SIZE)
+            self.__data_size = self.__fio.seek(0, io.SEEK_END)
+            self.__ifio: BinaryIO = open(self.index_path, "ab", buffering=0)
 
     def flush(self) -> None:
         """
-        Manually trigger writing all changes to disk.
+        Manually trigger handing all buffered changes to the OS. This does not wait for them to reach the disk.
+        """
+        if self.__fio is not None:
+            self.__fio.flush()
+            self._flush_index()
+
+    def sync(self) -> None:
+        """
+        Manually trigger writing all changes to disk, waiting until the OS reports them as stored.
         """
         if self.__fio is not None:
             self.__fio.flush()
+            os.fsync(self.__fio.fileno())
+            self._flush_index()
+            os.fsync(self.__ifio.fileno())
 
     def close(self) -> None:
         """
         Close database file.
         """
         self.__index = {}
+        self.__index_dirty = True
+        self.__fragment_count = 0
+        self.__index_size = 0
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__mm = None
+        self.__mm_generation = -1
         if self.__fio is not None:
+            self._write_batch()
+            self._flush_index()
             self.__fio.close()
             self.__fio = None
+            self.__ifio.close()
+            self.__ifio = None
+
+    def _decode(self, data: bytes) -> Any:
+        """
+        Decodes a JSON document, reusing the simdjson parser if it is in use.
+        Parameters
+        ----------
+        data: bytes
+            Encoded JSON document.
+        Returns
+        -------
+        Any
+            The decoded document.
+        """
+        if self.__parser is None:
+            return _loads(data)
+
+        try:
+            doc = self.__parser.parse(data)
+        except ValueError:
+            # simdjson rejects NaN, Infinity and integers beyond 64 bits, which the other backends accept.
+            return _loads(data)
+
+        # Documents returned by the parser are only valid until its next use, so materialize them.
+        if isinstance(doc, simdjson.Object):
+            return doc.as_dict()
+        if isinstance(doc, simdjson.Array):
+            return doc.as_list()
+        return doc
+
+    def _map(self) -> None:
+        """
+        (Re)maps the database file for reading. Pending writes are flushed first so they are visible in the map.
+        """
+        if self.__mm is not None:
+            self.__mm.close()
+            self.__mm = None
+
+        self.__fio.flush()
+        try:
+            self.__mm = mmap.mmap(self.__fio.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Empty files can't be mapped. Reads fall back to the file object.
+            pass
+
+        self.__mm_generation = self.__generation
+
+    def _pread_line(self, pos: int) -> bytes:
+        """
+        Reads a line without using or moving the file position. Pending writes must already be flushed.
+        Parameters
+        ----------
+        pos: int
+            Position of the start of the line.
+        Returns
+        -------
+        bytes
+            The line, without its newline.
+        """
+        size: int = _PREAD_SIZE
+        while True:
+            buf: bytes = os.pread(self.__fio.fileno(), size, pos)
+            end: int = buf.find(b"\n")
+            if end >= 0:
+                return buf[:end]
+            if len(buf) < size:
+                return buf
+            size *= 2
 
     @staticmethod
     def requires_fio(f: Callable) -> Callable:
@@ -81,84 +318,360 @@ class Jsondb:
             return f(self, *args, **kwargs)
         return wrapper
 
-    def _load_index(self, truncate: Optional[bool] = False, force: Optional[bool] = False) -> None:
+    def _find_trailer(self) -> Optional[int]:
+        """
+        Finds the index of a database written by older versions, which kept the index at the end of the database,
+        followed by its position on a line of its own.
+        Returns
+        -------
+        Optional[int]
+            Position of the index, or None if the database doesn't end in an index pointer.
+        """
+        # The pointer is on the last line. Search for the newline before it a chunk at a time.
+        tail: bytes = b""
+        chunk_end: int = self.__fio.seek(0, io.SEEK_END)
+        while chunk_end > 0:
+            chunk_pos: int = max(chunk_end - _TAIL_SIZE, 0)
+            self.__fio.seek(chunk_pos)
+            chunk: bytes = self.__fio.read(chunk_end - chunk_pos)
+            tail = chunk + tail
+
+            if (newline_pos := chunk.rfind(b'\n')) >= 0:
+                try:
+                    return int(tail[newline_pos + 1:].strip())
+                except ValueError:
+                    return None
+
+            chunk_end = chunk_pos
+
+        return None
+
+    def _read_trailer(self) -> Optional[tuple[dict, int]]:
+        """
+        Reads the index kept at the end of the database by older versions.
+        Returns
+        -------
+        Optional[tuple[dict, int]]
+            The index and its position, or None if the database has no readable index.
+        """
+        if (index_pos := self._find_trailer()) is None:
+            return None
+
+        self.__fio.seek(index_pos)
+        try:
+            index: Any = self._decode(self.__fio.readline())
+        except ValueError:
+            return None
+
+        if not isinstance(index, dict) or not all(isinstance(positions, list) for positions in index.values()):
+            return None
+
+        return index, index_pos
+
+    def _blank_trailer(self, index_pos: int) -> None:
+        """
+        Overwrites the index kept at the end of the database by older versions with spaces, keeping its newline, so
+        it can't be mistaken for a record when the index is rebuilt by scanning the database. Records keep their
+        positions.
+        Parameters
+        ----------
+        index_pos: int
+            Position of the index.
+        """
+        self.__fio.seek(index_pos)
+        lines: list[bytes] = self.__fio.read().split(b"\n")
+        self.__fio.seek(index_pos)
+        self.__fio.write(b"\n".join(b" " * len(line) for line in lines))
+
+    def _scan_index(self) -> dict:
+        """
+        Rebuilds the index by scanning every record in the database.
+        Returns
+        -------
+        dict
+            The index.
         """
-        Returns the database index and, optionally, removes it from the database.
+        index: dict = {}
+
+        self.__fio.seek(0)
+        pos: int = 0
+        for line in self.__fio:
+            try:
+                rec: Any = self._decode(line)
+            except ValueError:
+                rec = None
+
+            # Records hold exactly one key. Skip anything else.
+            if isinstance(rec, dict) and len(rec) == 1:
+                index.setdefault(next(iter(rec)), []).append(pos)
+            pos += len(line)
+
+        return index
+
+    def _load_index(self, force: Optional[bool] = False) -> None:
+        """
+        Loads the database index by merging the fragments in the index file. If there are none, the index file is
+        created from the database.
         Parameters
         ----------
-        truncate: Optional[bool]
-            If True, remove the index information from the database.
         force: Optional[bool]
             If True, always (re)load index. Otherwise, only load if not already loaded.
         """
+        # The cached index is kept up to date by add(), so only read it from disk again if another writer changed the
+        # index file. Replacing it changes its inode and appending to it changes its size.
+        if not self.__index_dirty and not force:
+            current: Optional[os.stat_result] = self._reopen_replaced_index()
+            if current is not None and current.st_size == self.__index_size:
+                return
 
         # Return to original pos after.
         original_pos: int = self.__fio.tell()
 
-        # Get last line pos. Contains index pos as str.
-        self.__fio.seek(0, io.SEEK_END)
-        index_pointer_pos: int = self.__fio.tell()
-        while index_pointer_pos > 1:
-            self.__fio.seek(index_pointer_pos)
-            if self.__fio.read(1) == '\n':
+        # Merge fragments in the order they were written so positions stay in file order.
+        self._flush_index()
+        with open(self.index_path, "rb") as f:
+            data: bytes = f.read()
+        self.__index_size = len(data)
+
+        # Anything after the last newline is a fragment still being written, or torn by a crash. Skip it, but leave it
+        # in place since its writer may not be done. New fragments are written on a line of their own.
+        lines: list[bytes] = data.split(b"\n")
+        self.__index_torn = bool(lines.pop())
+
+        index: dict = {}
+        fragment_count: int = 0
+        corrupt: bool = False
+        for line in lines:
+            if not line:
+                continue
+            try:
+                fragment: Any = self._decode(line)
+                # Valid JSON that isn't a dict of position lists is just as corrupt.
+                if not isinstance(fragment, dict) or not all(isinstance(p, list) for p in fragment.values()):
+                    raise ValueError("Index fragment is not a dict of positions.")
+            except ValueError:
+                corrupt = True
                 break
-            index_pointer_pos -= 1
+            for key, positions in fragment.items():
+                index.setdefault(key, []).extend(positions)
+            fragment_count += 1
 
-        if index_pointer_pos < 1:
-            return
+        if corrupt:
+            # Fragments after a corrupt one may still be fine, so rebuild the index from the records instead of
+            # dropping them. Compacting at the next add() replaces the corrupt index file.
+            index = self._scan_index()
+            # The scan finds records added in a batch too.
+            self.__batch_delta = {}
+            fragment_count = _COMPACT_THRESHOLD + 1
+        elif not fragment_count:
+            # Older databases keep the index at their end. Otherwise, rebuild it from the records.
+            if (trailer := self._read_trailer()) is not None:
+                index, index_pos = trailer
+                self._blank_trailer(index_pos)
+                # New records must start on a new line after the old index.
+                self.__fio.seek(0, io.SEEK_END)
+                self.__fio.write(b"\n")
+                self.__data_size = self.__fio.tell()
+            else:
+                index = self._scan_index()
+                self.__batch_delta = {}
 
-        # Get index.
-        try:
-            # Get line for index pos data.
-            self.__fio.seek(index_pointer_pos)
-            index_pos: int = int(self.__fio.read().strip())
-
-            # Don't retrieve if cached unless forced.
-            if (self.__index == {}) or force:
-                # Seek to start of index.
-                self.__fio.seek(index_pos)
-                # Read up to start of index pos data.
-                line: str = self.__fio.read(index_pointer_pos - index_pos)
-                self.__index = json.loads(line)
-
-            if truncate:
-                # Delete last line.
-                self.__fio.seek(index_pos)
-                self.__fio.truncate()
-        except (ValueError, json.decoder.JSONDecodeError):
-            pass
+            if index:
+                self._write_fragment(index)
+                fragment_count = 1
+
+        # Entries held back by a batch aren't in the index file yet.
+        for key, positions in self.__batch_delta.items():
+            index.setdefault(key, []).extend(positions)
+
+        self.__index = index
+        self.__index_dirty = False
+        self.__fragment_count = fragment_count
+        # Records may have been added by another writer, so the map needs refreshing too.
+        self.__generation += 1
 
         self.__fio.seek(original_pos)
 
+    def _write_batch(self) -> None:
+        """
+        Appends the index entries held back by the current batch to the index file.
+        """
+        if self.__batch_delta:
+            self._write_fragment(self.__batch_delta)
+            self.__batch_delta = {}
+
+    def _write_fragment(self, fragment: dict) -> None:
+        """
+        Appends an index fragment to the index file.
+        Parameters
+        ----------
+        fragment: dict
+            Index entries to store.
+        """
+        self.__index_pending += _dumps(fragment) + b"\n"
+        self.__fragment_count += 1
+        if len(self.__index_pending) >= _BUFFER_SIZE:
+            self._flush_index()
+
+    def _reopen_replaced_index(self) -> Optional[os.stat_result]:
+        """
+        Reopens the index file if another instance replaced it, e.g. by compacting it.
+        Returns
+        -------
+        Optional[os.stat_result]
+            The status of the open index file, or None if it was replaced.
+        """
+        current: os.stat_result = os.fstat(self.__ifio.fileno())
+        try:
+            on_disk: os.stat_result = os.stat(self.index_path)
+        except FileNotFoundError:
+            on_disk = None
+
+        if on_disk is not None and (on_disk.st_dev, on_disk.st_ino) == (current.st_dev, current.st_ino):
+            return current
+
+        self.__ifio.close()
+        self.__ifio = open(self.index_path, "ab", buffering=0)
+        self.__index_torn = False
+        return None
+
+    def _flush_index(self) -> None:
+        """
+        Writes buffered index fragments to the index file. The database is flushed first, so the index file never
+        points at records the OS hasn't seen.
+        """
+        if not self.__index_pending:
+            return
+
+        # Fragments written to a file another instance has replaced would be lost.
+        if self._reopen_replaced_index() is None:
+            self.__index_dirty = True
+
+        self.__fio.flush()
+
+        if self.__index_torn:
+            self.__index_pending[:0] = b"\n"
+            self.__index_torn = False
+
+        view: memoryview = memoryview(self.__index_pending)
+        while view:
+            view = view[self.__ifio.write(view):]
+        view.release()
+
+        self.__index_size += len(self.__index_pending)
+        self.__index_pending = bytearray()
+
     @requires_fio
     def add(self, new_items: dict, /) -> None:
         """
-        Add new entries.
+        Add new entries. Records are appended to the database and only their positions are appended to the index
+        file. Writes are buffered and only reach the OS once the buffer fills, on flush() or on close. Use sync() if
+        they must be durable.
         Parameters
         ----------
         new_items: dict
             New entries to add.
         """
-        self._load_index(truncate=True)
+        self._load_index()
+
+        # Another writer may have appended to the database. Our own writes never take it past the tracked end.
+        if os.fstat(self.__fio.fileno()).st_size > self.__data_size:
+            self.__data_size = self.__fio.seek(0, io.SEEK_END)
+
+        size: int = self.__data_size
+        buf = bytearray()
+
+        delta: dict = _encode_records(new_items, buf, size)
+        if not delta:
+            return
+
+        # Reads may have moved the file position. Seeking only when needed keeps earlier records in the buffer.
+        if self.__fio.tell() != size:
+            self.__fio.seek(size)
+
+        # Write items, then append the index fragment for them. Inside a batch, the fragment is written on exit.
+        self.__fio.write(buf)
+        self.__data_size += len(buf)
+        if self.__batch_depth:
+            for key, positions in delta.items():
+                self.__batch_delta.setdefault(key, []).extend(positions)
+        else:
+            self._write_fragment(delta)
+
+        for key, positions in delta.items():
+            self.__index.setdefault(key, []).extend(positions)
+
+        self.__generation += 1
+        if not self.__batch_depth and self.__fragment_count > _COMPACT_THRESHOLD:
+            self.compact()
+
+    @contextmanager
+    @requires_fio
+    def batch(self) -> Iterator["Jsondb"]:
+        """
+        Group many add() calls, writing the index entries for all of them as a single fragment once the block exits.
+        This is the recommended way to add many entries.
+        Returns
+        -------
+        Iterator[Jsondb]
+            This database.
+        """
+        self.__batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.__batch_depth -= 1
+            if not self.__batch_depth and self.__fio is not None:
+                self._write_batch()
+                if self.__fragment_count > _COMPACT_THRESHOLD:
+                    self.compact()
+
+    @requires_fio
+    def bulk_add(self, many_new_items: Iterable[dict], /) -> None:
+        """
+        Add new entries from many dicts in a single batch.
+        Parameters
+        ----------
+        many_new_items: Iterable[dict]
+            Dicts of new entries to add.
+        """
+        with self.batch():
+            for new_items in many_new_items:
+                self.add(new_items)
 
-        # Move to end of file and add newline. If file is empty, do not add newline.
-        self.__fio.seek(0, io.SEEK_END)
-        self.__fio.seek(max(self.__fio.tell() - 1, 0))
+    @requires_fio
+    def compact(self) -> None:
+        """
+        Replace the index file with a single fragment holding the whole index.
+        """
+        # Picks up anything another instance added to the index file.
+        self._load_index()
 
-        # Add items to db.
-        for key, value in new_items.items():
-            # Add new position to index.
-            self.__index.update({
-                key: self.__index.get(key, []) + [self.__fio.tell()]
-            })
+        # Records must reach the OS before an index pointing at them.
+        self.__fio.flush()
 
-            # Add item to db.
-            self.__fio.write(json.dumps({key: value}) + "\n")
+        # Each compaction gets a temporary file of its own, so instances compacting at the same time don't collide.
+        line: bytes = _dumps(self.__index) + b"\n"
+        fd, tmp_path = tempfile.mkstemp(prefix=self.index_path.name + ".", dir=self.index_path.parent)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(line)
+            # Open files can't be replaced on Windows.
+            self.__ifio.close()
+            os.replace(tmp_path, self.index_path)
+        except OSError:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        finally:
+            if self.__ifio.closed:
+                self.__ifio = open(self.index_path, "ab", buffering=0)
 
-        # Add index back to end of file.
-        index_pos = self.__fio.tell()
-        self.__fio.write(json.dumps(self.__index) + '\n')
-        self.__fio.write(str(index_pos))
+        # The whole index includes buffered fragments and entries held back by a batch.
+        self.__index_pending = bytearray()
+        self.__batch_delta = {}
+        self.__fragment_count = 1
+        self.__index_size = len(line)
+        self.__index_torn = False
 
     @requires_fio
     def get_many(self, keys: Sequence[Hashable]) -> dict[Hashable, list[Any]]:
@@ -177,12 +690,37 @@ class Jsondb:
 
         self._load_index()
 
+        # Gather every position first, so records can be read in file order.
+        plan: list[tuple[int, Hashable]] = []
+        prefixes: dict[Hashable, bytes] = {}
         for key in keys:
-            if target_positions := self.__index.get(key):
+            if key not in res and (target_positions := self.__index.get(key)):
                 res[key] = []
-                for target_pos in target_positions:
-                    self.__fio.seek(target_pos)
-                    res[key].extend(list(i for i in json.loads(self.__fio.readline()).values()))
+                prefixes[key] = _record_prefix(key)
+                plan.extend((target_pos, key) for target_pos in target_positions)
+        plan.sort(key=itemgetter(0))
+
+        if plan and self.__mm_generation != self.__generation:
+            self._map()
+
+        mm: mmap.mmap | None = self.__mm
+        for target_pos, key in plan:
+            if mm is not None:
+                rec: bytes = mm[target_pos:mm.find(b"\n", target_pos)]
+            elif hasattr(os, "pread"):
+                rec: bytes = self._pread_line(target_pos)
+            else:
+                self.__fio.seek(target_pos)
+                rec: bytes = self.__fio.readline()
+
+            # Records are written as {key: value}, so only the value needs decoding.
+            # Anything written differently is decoded in full.
+            rec = rec.rstrip()
+            prefix: bytes = prefixes[key]
+            if rec.startswith(prefix) and rec.endswith(b"}"):
+                res[key].append(self._decode(rec[len(prefix):-1]))
+            else:
+                res[key].extend(self._decode(rec).values())
 
         return res
 
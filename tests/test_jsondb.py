@@ -0,0 +1,330 @@
+import json
+import math
+import os
+import tempfile
+import unittest
+from unittest import mock
+from pathlib import Path
+
+import jsondb
+from jsondb import Jsondb
+
+
+def write_baseline(path: Path, records: list[tuple], newline: str = "\n") -> None:
+    """
+    Writes a database the way the original text-mode implementation did: one record per line, then the index, then
+    the position of the index.
+    """
+    data: str = ""
+    index: dict = {}
+    for key, value in records:
+        index.setdefault(key, []).append(len(data.encode()))
+        data += json.dumps({key: value}) + newline
+    Path(path).write_bytes((data + json.dumps(index) + newline + str(len(data.encode()))).encode())
+
+
+class JsondbTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / "test.db"
+
+        self.index_path = Path(self.tmp.name) / "test.db.idx"
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+
+class TestAdd(JsondbTestCase):
+    def test_append_keeps_previous_records(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 1, "b": "x"})
+            db.add({"a": [2]})
+        with Jsondb(self.path) as db:
+            db.add({"c": {"d": 3}, "a": 4})
+            self.assertEqual(db.get("a"), [1, [2], 4])
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get_many(["a", "b", "c", "e"]), {"a": [1, [2], 4], "b": ["x"], "c": [{"d": 3}]})
+
+    def test_writes_stay_buffered(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 1})
+            db.add({"b": 2})
+            self.assertEqual(self.path.stat().st_size, 0)
+            db.flush()
+            size: int = self.path.stat().st_size
+            self.assertGreater(size, 0)
+
+            # Reading moves the file position. Adding afterwards still appends at the end.
+            self.assertEqual(db.get("a"), [1])
+            db.add({"a": 3})
+            self.assertEqual(self.path.stat().st_size, size)
+            self.assertEqual(db.get("a"), [1, 3])
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get_many(["a", "b"]), {"a": [1, 3], "b": [2]})
+
+    def test_append_to_baseline(self):
+        write_baseline(self.path, [("a", 1), ("b", 2), ("a", 3)])
+        with Jsondb(self.path) as db:
+            db.add({"a": 4})
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, 3, 4])
+            self.assertEqual(db.get("b"), [2])
+
+
+class TestIndexFile(JsondbTestCase):
+    def test_migrate_baseline(self):
+        write_baseline(self.path, [("a", 1), ("b", {"c": 2}), ("a", [3])])
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get_many(["a", "b"]), {"a": [1, [3]], "b": [{"c": 2}]})
+            db.add({"a": 4})
+
+        # The old index is blanked out and new records start on a line of their own.
+        self.assertNotIn(b"[", self.path.read_bytes().split(b"\n")[3])
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, [3], 4])
+            self.assertEqual(db.get("b"), [{"c": 2}])
+
+    def test_migrate_baseline_pointer_across_chunks(self):
+        write_baseline(self.path, [(f"k{i}", i) for i in range(1000)])
+        with mock.patch.object(jsondb, "_TAIL_SIZE", 2), Jsondb(self.path) as db:
+            self.assertEqual(db.get("k999"), [999])
+
+    def test_rescan_after_migration(self):
+        # The old index {"a": [0]} looks just like a record.
+        write_baseline(self.path, [("a", 1)])
+        with Jsondb(self.path) as db:
+            db.add({"a": [0]})
+            db.add({"a": 2})
+        with Jsondb(self.path) as db:
+            db.add({"a": [42]})
+            db.add({"a": 9})
+
+        self.index_path.unlink()
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, [0], 2, [42], 9])
+
+    def test_rebuild_missing_index(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 1, "b": 2})
+            db.add({"a": 3})
+        self.index_path.write_bytes(b"")
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get_many(["a", "b"]), {"a": [1, 3], "b": [2]})
+        self.assertEqual(self.index_path.read_bytes().count(b"\n"), 1)
+
+    def test_torn_last_fragment(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 1})
+        with open(self.index_path, "ab") as f:
+            f.write(b'{"a":[12')
+
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1])
+            db.add({"a": 2})
+        # The partial fragment is left alone and the next one starts on a new line.
+        self.assertIn(b'{"a":[12\n', self.index_path.read_bytes())
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, 2])
+
+    def test_corrupt_fragment(self):
+        for garbage in (b"not json", b"[1,2]", b'{"a":5}', b"null"):
+            with self.subTest(garbage=garbage):
+                self.path.write_bytes(b"")
+                self.index_path.write_bytes(b"")
+                with Jsondb(self.path) as db:
+                    db.add({"a": 1})
+                with open(self.index_path, "ab") as f:
+                    f.write(garbage + b"\n")
+                with Jsondb(self.path) as db:
+                    db.add({"a": 2})
+
+                # Fragments after the corrupt one are kept, and the next add() compacts the index.
+                with Jsondb(self.path) as db:
+                    self.assertEqual(db.get("a"), [1, 2])
+                    db.add({"a": 3})
+                self.assertNotIn(garbage, self.index_path.read_bytes())
+                with Jsondb(self.path) as db:
+                    self.assertEqual(db.get("a"), [1, 2, 3])
+
+    def test_index_written_after_records(self):
+        # Large enough for both files to be written before the end of add().
+        items: dict = {f"k{i}": i for i in range(100_000)}
+        with Jsondb(self.path) as db:
+            db.add(items)
+
+            size: int = self.path.stat().st_size
+            for line in self.index_path.read_bytes().split(b"\n")[:-1]:
+                for positions in json.loads(line).values():
+                    self.assertTrue(all(pos < size for pos in positions))
+
+    def test_compact(self):
+        with Jsondb(self.path) as db:
+            for i in range(jsondb._COMPACT_THRESHOLD + 1):
+                db.add({"a": i})
+            db.flush()
+            self.assertEqual(self.index_path.read_bytes().count(b"\n"), 1)
+            db.add({"a": -1})
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), list(range(jsondb._COMPACT_THRESHOLD + 1)) + [-1])
+            db.compact()
+            db.compact()
+        self.assertEqual(sorted(os.listdir(self.tmp.name)), ["test.db", "test.db.idx"])
+
+    def test_two_instances(self):
+        a: Jsondb = Jsondb(self.path)
+        b: Jsondb = Jsondb(self.path)
+        try:
+            a.add({"a": 1})
+            b.add({"b": 1})
+            a.flush()
+            b.flush()
+
+            # a compacts, replacing the index file b has open. b's fragments must reach the new file.
+            for i in range(jsondb._COMPACT_THRESHOLD + 1):
+                a.add({"a": i + 2})
+            a.flush()
+            b.add({"b": 2})
+            b.compact()
+            b.add({"b": 3})
+            a.flush()
+            b.flush()
+        finally:
+            a.close()
+            b.close()
+
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("b"), [1, 2, 3])
+            self.assertEqual(db.get("a"), [1] + list(range(2, jsondb._COMPACT_THRESHOLD + 3)))
+
+
+class TestCachedIndex(JsondbTestCase):
+    def test_reload_after_other_instance(self):
+        a: Jsondb = Jsondb(self.path)
+        b: Jsondb = Jsondb(self.path)
+        try:
+            self.assertEqual(b.get("a"), [])
+            a.add({"a": 1})
+            a.flush()
+            self.assertEqual(b.get("a"), [1])
+
+            for i in range(jsondb._COMPACT_THRESHOLD + 1):
+                a.add({"a": i + 2})
+            a.flush()
+            self.assertEqual(b.get("a"), [1] + list(range(2, jsondb._COMPACT_THRESHOLD + 3)))
+        finally:
+            a.close()
+            b.close()
+
+    def test_cached_get(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 1})
+            db.flush()
+            size: int = self.index_path.stat().st_size
+            db.add({"a": 2})
+            self.assertEqual(db.get("a"), [1, 2])
+
+            # Checking the cached index neither writes pending fragments nor stats the index file more than needed.
+            with mock.patch("os.fstat", wraps=os.fstat) as fstat, mock.patch("os.stat", wraps=os.stat) as stat:
+                self.assertEqual(db.get("a"), [1, 2])
+            self.assertEqual((fstat.call_count, stat.call_count), (1, 1))
+            self.assertEqual(self.index_path.stat().st_size, size)
+
+
+class TestBatch(JsondbTestCase):
+    def test_batch(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 0})
+            with db.batch():
+                db.add({"a": 1, "b": 1})
+                self.assertEqual(db.get("a"), [0, 1])
+                with db.batch():
+                    db.add({"a": 2})
+                db.add({"b": 2})
+            db.flush()
+            self.assertEqual(self.index_path.read_bytes().count(b"\n"), 2)
+            self.assertEqual(db.get_many(["a", "b"]), {"a": [0, 1, 2], "b": [1, 2]})
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get_many(["a", "b"]), {"a": [0, 1, 2], "b": [1, 2]})
+
+    def test_bulk_add(self):
+        with Jsondb(self.path) as db:
+            db.bulk_add({"a": i} for i in range(jsondb._COMPACT_THRESHOLD * 2))
+            db.flush()
+            self.assertEqual(self.index_path.read_bytes().count(b"\n"), 1)
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), list(range(jsondb._COMPACT_THRESHOLD * 2)))
+
+    def test_rebuild_inside_batch(self):
+        # The index is rebuilt from the records, which already include the ones added in the batch.
+        with Jsondb(self.path) as db:
+            with db.batch():
+                db.add({"a": 1})
+                db.add({"a": 2})
+                db.compact()
+                self.assertEqual(db.get("a"), [1, 2])
+                db.add({"a": 3})
+            self.assertEqual(db.get("a"), [1, 2, 3])
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, 2, 3])
+
+    def test_rebuild_corrupt_index_inside_batch(self):
+        with Jsondb(self.path) as db:
+            db.add({"a": 0})
+        with open(self.index_path, "ab") as f:
+            f.write(b"not json\n")
+
+        with Jsondb(self.path) as db:
+            with db.batch():
+                db.add({"a": 1})
+                db.add({"a": 2})
+                db.compact()
+                self.assertEqual(db.get("a"), [0, 1, 2])
+                db.add({"a": 3})
+            self.assertEqual(db.get("a"), [0, 1, 2, 3])
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [0, 1, 2, 3])
+
+
+class TestGet(JsondbTestCase):
+    def test_baseline_crlf_records(self):
+        # Written in text mode on Windows.
+        write_baseline(self.path, [("a", 1), ("b", "x"), ("a", [0])], newline="\r\n")
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, [0]])
+            self.assertEqual(db.get_many(["b", "a"]), {"b": ["x"], "a": [1, [0]]})
+
+    def test_records_in_other_layouts(self):
+        self.path.write_bytes(b'{ "a" :1 }\n{"a":2 }\t\n{"a": [0, 11]}\n21')
+        with Jsondb(self.path) as db:
+            self.assertEqual(db.get("a"), [1, 2])
+
+
+class TestValues(JsondbTestCase):
+    def test_round_trip_special_numbers(self):
+        values: dict = {"nan": math.nan, "inf": math.inf, "ninf": -math.inf, "big": 2 ** 70, "neg": -2 ** 70,
+                        "nested": [math.nan, 2 ** 64, {"x": None}], "none": None}
+        with Jsondb(self.path) as db:
+            db.add(values)
+
+        with Jsondb(self.path) as db:
+            self.assertTrue(math.isnan(db.get("nan")[0]))
+            self.assertEqual(db.get("inf"), [math.inf])
+            self.assertEqual(db.get("ninf"), [-math.inf])
+            self.assertEqual(db.get("big"), [2 ** 70])
+            self.assertIsInstance(db.get("big")[0], int)
+            self.assertEqual(db.get("neg"), [-2 ** 70])
+            nested: list = db.get("nested")[0]
+            self.assertTrue(math.isnan(nested[0]))
+            self.assertEqual(nested[1:], [2 ** 64, {"x": None}])
+            self.assertEqual(db.get("none"), [None])
+
+    def test_read_baseline_special_numbers(self):
+        write_baseline(self.path, [("nan", math.nan), ("big", 2 ** 70), ("inf", math.inf)])
+        with Jsondb(self.path) as db:
+            self.assertTrue(math.isnan(db.get("nan")[0]))
+            self.assertEqual(db.get("big"), [2 ** 70])
+            self.assertEqual(db.get("inf"), [math.inf])
+
+
+if __name__ == "__main__":
+    unittest.main()